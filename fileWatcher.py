@@ -7,21 +7,20 @@ See full details in process_args() below. or running python filesWatcher.py -h
 
 """
 
-import glob
+import fnmatch
+import functools
 import os.path
 import time
 import re
-import yaml
-import subprocess
+import shlex
+import threading
+from collections import ChainMap
 from argparse import ArgumentParser, Namespace, RawTextHelpFormatter
-from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, DirCreatedEvent, FileCreatedEvent, DirDeletedEvent, \
     FileDeletedEvent, DirModifiedEvent, FileModifiedEvent, DirMovedEvent, FileMovedEvent
 
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+# Note: yaml, json, subprocess, re2 and watchdog's Observer are imported where they're used,
+#       so that -h and argument errors don't pay for loading them.
 
 
 def process_args() -> tuple[Namespace, ArgumentParser]:
@@ -120,43 +119,235 @@ def process_args() -> tuple[Namespace, ArgumentParser]:
     return args, arg_parser
 
 
+# After the first change, keep collecting changes until none arrive for DEBOUNCE_GAP seconds,
+# but for no longer than DEBOUNCE_MAX seconds.
+DEBOUNCE_GAP = 0.05
+DEBOUNCE_MAX = 0.5
+
+# Keys of a monitor definition that hold commands to execute.
+COMMANDS_KEYS = ('commands', 'completed', 'error', 'skipped', 'started')
+
+# Commands containing any of these characters, or starting with a shell builtin, are run through the shell.
+SHELL_META_PATTERN = re.compile(r'[|&;<>$`*?(){}\[\]"\'\\~#=!%\n]')
+SHELL_BUILTINS = {'.', ':', 'alias', 'bg', 'case', 'cd', 'command', 'eval', 'exec', 'exit', 'export', 'fg', 'for',
+                  'getopts', 'hash', 'if', 'jobs', 'read', 'readonly', 'return', 'set', 'shift', 'source', 'times',
+                  'trap', 'type', 'ulimit', 'umask', 'unalias', 'unset', 'until', 'wait', 'while'}
+
+# Glob wildcard characters, as glob.has_magic() checks for.
+MAGIC_PATTERN = re.compile('[*?[]')
+
+# Matches search patterns that only test a file extension, e.g. '.*\.js$'
+SUFFIX_PATTERN = re.compile(r'^\.\*\\\.([a-zA-Z0-9]+)\$$')
+
+
+def split_suffix_patterns(patterns):
+    """Splits patterns into a tuple of plain file suffixes (for str.endswith) and the remaining regular expressions.
+
+    Duplicates are dropped, keeping the first occurrence's order.
+    """
+    suffixes = {}
+    regexes = {}
+    for pattern in patterns:
+        match = SUFFIX_PATTERN.match(pattern)
+        if match:
+            suffixes['.' + match.group(1)] = None
+        else:
+            regexes[pattern] = None
+    return tuple(suffixes), list(regexes)
+
+
+@functools.cache
+def load_re2():
+    """Returns the optional google-re2 module, which gives linear-time matching of combined search patterns,
+    or None if it isn't installed. Cached, since a failed import isn't.
+    """
+    try:
+        import re2
+    except ImportError:
+        return None
+    return re2
+
+
+def compile_patterns(patterns) -> list:
+    """Compiles a list of regular expressions, combining them into one alternation when that's safe,
+    so a path is matched in a single scan.
+
+    Patterns with groups (backreferences would be renumbered) or global inline flags (only allowed at the start)
+    are kept as a list of separately compiled patterns.
+    """
+    compiled = [re.compile(pattern) for pattern in patterns]
+    if len(compiled) < 2 or any(pattern.groups or pattern.flags != re.UNICODE for pattern in compiled):
+        return compiled
+
+    fused = "(?:" + "|".join(f"(?:{pattern})" for pattern in patterns) + ")"
+    re2 = load_re2()
+    if re2 is not None:
+        try:
+            return [re2.compile(fused)]
+        except re2.error:
+            # Fall back to python's re for syntax RE2 doesn't support.
+            pass
+    try:
+        return [re.compile(fused)]
+    except re.error:
+        return compiled
+
+
+def prepare_command(command: str) -> str | list[str]:
+    """Returns the command split into an argument list if it can be run without a shell, else the command string."""
+    if SHELL_META_PATTERN.search(command):
+        return command
+    args = shlex.split(command)
+    if not args or args[0] in SHELL_BUILTINS:
+        return command
+    return args
+
+
+def iter_roots(path_glob):
+    """Lazily expands a path glob, like glob.iglob(path_glob, recursive=True), into the paths to watch.
+
+    Since watches are recursive, a trailing '**' isn't expanded: its parent directory already covers the tree.
+    Directories are listed with os.scandir(), reusing the type information from each DirEntry.
+    """
+    if not MAGIC_PATTERN.search(path_glob):
+        if os.path.lexists(path_glob):
+            yield path_glob
+        return
+
+    # Split into a fixed prefix and the wildcard tail, dropping the trailing '**'s.
+    parts = path_glob.split(os.sep)
+    dir_only = False
+    while parts and parts[-1] in ('**', ''):
+        dir_only = True
+        parts.pop()
+    i_magic = next((i for i, part in enumerate(parts) if MAGIC_PATTERN.search(part)), len(parts))
+    prefix = os.sep.join(parts[:i_magic]) or (os.sep if path_glob.startswith(os.sep) else '')
+
+    # A glob of only a prefix and '**'s is just the prefix directory.
+    if i_magic == len(parts):
+        if not prefix:
+            # Without a prefix, glob yields relative paths without a './', so watch each top-level entry instead.
+            yield from _iter_glob_parts('', ['*'], path_glob.endswith(os.sep))
+        elif os.path.isdir(prefix):
+            yield prefix
+        return
+
+    yield from _iter_glob_parts(prefix, parts[i_magic:], dir_only)
+
+
+def _iter_glob_parts(dirname, parts, dir_only):
+    """Yields the paths under dirname matching the remaining glob parts."""
+    part, rest = parts[0], parts[1:]
+    want_dir = bool(rest) or dir_only
+
+    if part == '**':
+        # Zero or more directories.
+        for subdir in _iter_subdirs(dirname):
+            yield from _iter_glob_parts(subdir, rest, dir_only) if rest else [subdir]
+        return
+
+    if not MAGIC_PATTERN.search(part):
+        path = os.path.join(dirname, part)
+        if os.path.isdir(path) if want_dir else os.path.lexists(path):
+            yield from _iter_glob_parts(path, rest, dir_only) if rest else [path]
+        return
+
+    try:
+        with os.scandir(dirname or os.curdir) as it:
+            entries = [entry for entry in it
+                       if (part.startswith('.') or not entry.name.startswith('.'))
+                       and fnmatch.fnmatch(entry.name, part)]
+    except OSError:
+        return
+    for entry in entries:
+        if want_dir and not _is_dir(entry):
+            continue
+        path = os.path.join(dirname, entry.name)
+        yield from _iter_glob_parts(path, rest, dir_only) if rest else [path]
+
+
+def _iter_subdirs(dirname):
+    """Yields dirname and all its non-hidden subdirectories, as glob's '**' does."""
+    yield dirname
+    try:
+        with os.scandir(dirname or os.curdir) as it:
+            subdirs = [entry.name for entry in it if not entry.name.startswith('.') and _is_dir(entry)]
+    except OSError:
+        return
+    for name in subdirs:
+        yield from _iter_subdirs(os.path.join(dirname, name))
+
+
+def _is_dir(entry: os.DirEntry) -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
 
 class MonitorAnyFileChange(FileSystemEventHandler):
     """An event handler class for Observer instances.
     For the patch being monitored, keeps track of the 'commands', the file extensions and state of events.
     """
 
-    def __init__(self, path, monitor_defn, monitor):
+    def __init__(self, path, monitor_defn, monitor, change_event: threading.Event, changed_files: set,
+                 triggered: dict, is_file: bool = False):
         super().__init__()
 
         # Store parameters
         self._path = path
+        self._is_file = is_file
+        self._abs_path = os.path.abspath(path)
         self.monitor_defn = monitor_defn
         self._monitor = monitor
+        self._change_event = change_event
+        self._triggered = triggered
 
-        # Init
-        self._files = set()
+        # Changed files, shared by all handlers of the same monitor definition.
+        self._files = changed_files
 
-    def has_change(self) -> bool:
-        """Returns True iff any file change event has occurred. """
-        return len(self._files) > 0
+        # Compile the optional patterns once, rather than on every event.
+        # Pure extension patterns are checked with str.endswith(), the rest with a regex.
+        self._has_patterns = 'patterns' in monitor
+        self._suffixes, regexes = split_suffix_patterns(monitor['patterns'] if self._has_patterns else [])
+        self._patterns = compile_patterns(regexes)
 
-    def get_files(self):
-        return self._files
+        # Patterns are for file names, so directory events are dropped before they're matched.
+        self.ignore_directories = self._has_patterns
+
+    def dispatch(self, event) -> None:
+        """Drops directory events when ignore_directories is set, as watchdog's PatternMatchingEventHandler does."""
+        if self.ignore_directories and event.is_directory:
+            return
+        super().dispatch(event)
 
     def _handle_event(self, event):
         """Event handler for an Observer.
 
         If a matching any file extension or no extensions given for the target,
-        records the event's filepath reference.
+        records the event's filepath reference and wakes up FilesWatcher.start().
+        Once the monitor definition has a change, its commands will run, so further matching events aren't recorded.
+        They still wake up FilesWatcher._wait_for_quiet(), so a burst of matching changes is batched until it ends,
+        while non-matching events don't extend the batch.
         """
-        if 'patterns' in self._monitor:
-            for file_extension in self._monitor['patterns']:
-                if re.match(file_extension, event.src_path):
-                    self._files.add(event.src_path)
-                    break
-        elif event.src_path:
-            self._files.add(event.src_path)
+        # A watched file only cares about events for itself, not its siblings.
+        if self._is_file and os.path.abspath(event.src_path) != self._abs_path:
+            return
+
+        if self._has_patterns:
+            if not (self._suffixes and event.src_path.endswith(self._suffixes)) \
+                    and not any(pattern.match(event.src_path) for pattern in self._patterns):
+                return
+        elif not event.src_path:
+            return
+
+        if self._files:
+            self._change_event.set()
+            return
+
+        self._files.add(event.src_path)
+        self._triggered.setdefault(self.monitor_defn['__key'], (self.monitor_defn['__index'], self))
+        self._change_event.set()
 
     def on_created(self, event: DirCreatedEvent | FileCreatedEvent) -> None:
         """@see _handle_event()"""
@@ -181,21 +372,50 @@ class FilesWatcher:
     def __init__(self, args, parser):
         self.args = args
         self.parser = parser
-        self.event_handlers = []
         self._monitor_defns_defaults = {}
         self.observer = None
 
+        # Set by any event handler that records a change.
+        self._change_event = threading.Event()
+
+        # Changed files keyed by monitor definition's '__key'.
+        self._changed: dict[str, set] = {}
+
+        # The monitor definition's '__index' and first event handler to record a change, keyed by its '__key'.
+        self._triggered: dict[str, tuple[int, MonitorAnyFileChange]] = {}
+
+        # Number of monitor definitions loaded, across all YAML files. Gives each its YAML order '__index'.
+        self._defn_count = 0
+
+        # Parsed YAML files keyed by path, with the mtime and size they were parsed at.
+        self._yaml_cache: dict[str, tuple[int, int, dict]] = {}
+
+        # os.path.isfile(), cached while the YAML files are being loaded. See _setup_observers().
+        self._isfile = os.path.isfile
+
     def _setup_observers(self):
         """Observers and event handlers are recreated on each call to start(). """
-        self.event_handlers = []
+        from watchdog.observers import Observer
+
+        self._changed = {}
+        self._triggered = {}
+        self._defn_count = 0
+        self._change_event = threading.Event()
         self.observer = Observer()
 
+        # Paths often repeat across monitor definitions, so only probe each once while loading.
+        self._isfile = functools.lru_cache(maxsize=4096)(os.path.isfile)
+
         # Parse monitor yamls and start them.
         print("Monitoring:")
-        for yaml_file in self.args.paths:
-            with open(yaml_file, 'r') as f:
-                monitor_defns = yaml.load(f, Loader=Loader)
+        try:
+            for yaml_file in self.args.paths:
+                monitor_defns = self._load_yaml(yaml_file)
                 self._start_monitors(yaml_file, monitor_defns)
+        finally:
+            # Later calls must see the filesystem as it is then.
+            self._isfile.cache_clear()
+            self._isfile = os.path.isfile
 
         try:
             self.observer.start()
@@ -203,6 +423,65 @@ class FilesWatcher:
             if self.args.exit_on_error:
                 exit(1)
 
+    def _load_yaml(self, yaml_file):
+        """Returns the parsed YAML file, only re-parsing it if its mtime or size changed since the last call."""
+        import json
+        import yaml
+        try:
+            from yaml import CSafeLoader as Loader
+        except ImportError:
+            from yaml import SafeLoader as Loader
+
+        st = os.stat(yaml_file)
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._yaml_cache.get(yaml_file)
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+
+        # Prefer the JSON sidecar written by a previous parse, if it was written for this exact mtime and size.
+        # Comparing sidecar and YAML mtimes isn't enough: 'cp -p', 'rsync -t' or tar can restore an older YAML.
+        json_file = yaml_file + '.cache.json'
+        monitor_defns = None
+        if os.path.exists(json_file):
+            try:
+                with open(json_file, 'r') as f:
+                    json_cache = json.load(f)
+                if isinstance(json_cache, dict) and json_cache.get('yaml_key') == list(key):
+                    monitor_defns = json_cache.get('monitor_defns')
+            except (OSError, ValueError):
+                # Unreadable or corrupt. Just parse the YAML.
+                monitor_defns = None
+
+        if monitor_defns is None:
+            with open(yaml_file, 'r') as f:
+                monitor_defns = yaml.load(f, Loader=Loader)
+            self._write_json_cache(json_file, key, monitor_defns)
+
+        self._yaml_cache[yaml_file] = (*key, monitor_defns)
+        return monitor_defns
+
+    @staticmethod
+    def _write_json_cache(json_file, yaml_key, monitor_defns):
+        """Writes the parsed YAML as JSON, with the YAML's (mtime_ns, size), which is much faster to load on the
+        next start.
+        """
+        import json
+
+        tmp_file = json_file + '.tmp'
+        try:
+            # Skip YAML that doesn't survive the round-trip, e.g. int, bool or null keys come back as strings.
+            text = json.dumps(monitor_defns)
+            if json.loads(text) != monitor_defns:
+                return
+
+            with open(tmp_file, 'w') as f:
+                json.dump({'yaml_key': list(yaml_key), 'monitor_defns': monitor_defns}, f)
+            os.replace(tmp_file, json_file)
+        except (OSError, TypeError, ValueError):
+            # Not writable, or not representable as JSON. Just parse the YAML next time.
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
     def _start_monitors(self, source, monitor_defns):
         self._monitor_defns_defaults = {}
 
@@ -212,26 +491,22 @@ class FilesWatcher:
                 self._monitor_defns_defaults = monitor_defn
                 continue
 
-            # At yaml key as a name and as a compined source filename and monitor name.
-            monitor_defn = self._monitor_defns_defaults | monitor_defn
-            monitor_defn['__name'] = defn_name
-            monitor_defn['__key'] = f"{source}:{defn_name}"
+            # At yaml key as a name and as a compined source filename and monitor name, and its YAML order.
+            # The defaults are layered underneath as a view rather than copied. Writes only go to the first map.
+            monitor_defn = ChainMap({'__name': defn_name, '__key': f"{source}:{defn_name}",
+                                     '__index': self._defn_count},
+                                    monitor_defn, self._monitor_defns_defaults)
+            self._defn_count += 1
+
+            self._normalize_defn(monitor_defn)
 
             # Loop over search paths
-            searches = monitor_defn['searches']
-            if isinstance(searches, str):
-                searches = [{"paths": [searches]}]
-            elif isinstance(searches[0], str):
-                searches = [{"paths": searches}]
-            for search_defn in searches:
+            for search_defn in monitor_defn['searches']:
                 found_path = False
                 i_glob = None
                 path_glob = None
-                paths = search_defn['paths']
-                if isinstance(paths, str):
-                    paths = [paths]
-                for i_glob, path_glob in enumerate(paths):
-                    for path in glob.iglob(path_glob, recursive=True):
+                for i_glob, path_glob in enumerate(search_defn['paths']):
+                    for path in iter_roots(path_glob):
                         found_path = True
                         self._add_monitor(path, monitor_defn, search_defn)
 
@@ -241,78 +516,104 @@ class FilesWatcher:
                     if self.args.exit_on_error:
                         exit(1)
 
+    @staticmethod
+    def _as_list(value):
+        """Support a single string as a short form of a list of one string."""
+        return [value] if isinstance(value, str) else value
+
+    def _normalize_defn(self, monitor_defn: ChainMap):
+        """Rewrites the short forms in a monitor definition once, so that later code only sees lists.
+
+        Only the ChainMap's own map is written to, leaving the (cached) YAML data untouched.
+        """
+        # Searches become a list of search dicts, each with a list of paths.
+        searches = self._as_list(monitor_defn['searches'])
+        if isinstance(searches[0], str):
+            searches = [{"paths": searches}]
+        monitor_defn['searches'] = [search_defn | {'paths': self._as_list(search_defn['paths'])}
+                                    for search_defn in searches]
+
+        # Substitute the monitor's name and decide whether each command needs a shell.
+        for commands_key in COMMANDS_KEYS:
+            if commands_key in monitor_defn:
+                monitor_defn[commands_key] = [prepare_command(command.replace('_MONITOR_NAME_', monitor_defn['__name']))
+                                              for command in self._as_list(monitor_defn[commands_key])]
+
     def _add_monitor(self, path: str, monitor_defn, monitor):
         """Create and starts a new path Observer."""
 
         # Create Observer event handlers that contain extra context information.
-        event_handler = MonitorAnyFileChange(path, monitor_defn, monitor)
-        self.observer.schedule(event_handler, path, recursive=True)
-        self.event_handlers.append(event_handler)
+        monitor_key = monitor_defn['__key']
+        changed_files = self._changed.setdefault(monitor_key, set())
+        is_file = self._isfile(path)
+        event_handler = MonitorAnyFileChange(path, monitor_defn, monitor, self._change_event, changed_files,
+                                             self._triggered, is_file=is_file)
+
+        # The observer shares one emitter between all handlers scheduled with the same (path, recursive).
+        # The path is scheduled as given, since search patterns match the event paths as the user wrote them.
+        # Files are watched on their own, not recursively.
+        self.observer.schedule(event_handler, path, recursive=not is_file)
 
     def start(self):
         """
-        :return: A set of target names where files have been changed (within 1 second of first change found)
+        :return: A set of target names where files have been changed (within 0.5 seconds of first change found)
         """
         self._setup_observers()
 
         # Monitor until a path change is observed.
         try:
-            # 1 sec periodically check if there are any changes.
-            has_change = False
-            while not has_change:
-                for event_handler in self.event_handlers:
-                    if event_handler.has_change():
-                        has_change = True
-                        break
-
-                time.sleep(1)
-            
+            # Block until an event handler records a change.
+            self._change_event.wait()
+
         finally:
-            # Wait 1 more second for any other changes, before stopping observer.
-            time.sleep(1)
+            # Batch any other changes, before stopping observer.
+            self._wait_for_quiet()
 
             # Stop observer
             self.observer.stop()
             self.observer.join()
 
-        # Keeping set of defn's run to avoid running twice.
-        triggered_monitor_defn_keys = set()
-
         # Check if optional --skip-file {file} exists.
         has_skip_file = self.args.skip_file and os.path.exists(self.args.skip_file)
 
-        # Iterate over event_handlers to find out which ones triggered.
-        for event_handler in self.event_handlers:
-            if event_handler.has_change():
-
-                # Only execute commands for unrun monitor definitions.
-                monitor_key = event_handler.monitor_defn['__key']
-                if not monitor_key in triggered_monitor_defn_keys:
-                    triggered_monitor_defn_keys.add(monitor_key)
-
-                    if has_skip_file:
-                        # Run 'skipped' commands
-                        self._run_commands(event_handler.monitor_defn, 'skipped')
-                    else:
-                        # Run 'commands'
-                        print(f"Executing {monitor_key}")
-                        res = self._run_commands(event_handler.monitor_defn, 'commands')
-                        self._run_commands(event_handler.monitor_defn, 'completed' if res == 0 else 'error')
-                        print()
+        # Iterate over only the triggered monitor definitions, in YAML order so users can sequence their commands.
+        # Each definition appears once, however many of its handlers saw changes.
+        for _, event_handler in sorted(self._triggered.values(), key=lambda entry: entry[0]):
+            monitor_defn = event_handler.monitor_defn
+            monitor_key = monitor_defn['__key']
+
+            if has_skip_file:
+                # Run 'skipped' commands
+                self._run_commands(monitor_defn, 'skipped')
+            else:
+                # Run 'commands'
+                print(f"Executing {monitor_key}")
+                res = self._run_commands(monitor_defn, 'commands')
+                self._run_commands(monitor_defn, 'completed' if res == 0 else 'error')
+                print()
+
+    def _wait_for_quiet(self):
+        """Returns once no change is seen for DEBOUNCE_GAP seconds, or after DEBOUNCE_MAX seconds in total."""
+        deadline = time.monotonic() + DEBOUNCE_MAX
+        while time.monotonic() < deadline:
+            self._change_event.clear()
+            if not self._change_event.wait(DEBOUNCE_GAP):
+                break
 
     def _run_commands(self, monitor_defn, commands_key):
+        import subprocess
+
         # If there is a list of commands to run
         if commands_key in monitor_defn:
 
-            # Support commands as a single string, rather than a list of strings.
-            commands = monitor_defn[commands_key]
-            if isinstance(commands, str):
-                commands = [commands]
-
-            # Execute each command.
-            for command in commands:
-                command = command.replace('_MONITOR_NAME_', monitor_defn['__name'])
-                res = subprocess.run(command, shell=True)
+            # Execute each command, either as a shell string or an argument list. See prepare_command().
+            for command in monitor_defn[commands_key]:
+                try:
+                    res = subprocess.run(command, shell=isinstance(command, str))
+                except OSError as e:
+                    # As the shell would, report a missing or non-executable command.
+                    print(f"ERROR: {e}")
+                    return 127
                 if res.returncode:
                     # Return process error code.
                     return res.returncode
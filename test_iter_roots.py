@@ -0,0 +1,67 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from fileWatcher import iter_roots
+
+
+class TestIterRoots(unittest.TestCase):
+    """iter_roots() must cover what glob.iglob() yields, spelled the same way, with no extra paths."""
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._root = tempfile.mkdtemp()
+        os.chdir(self._root)
+        for path in ['g/a/b/c', 'g/a/.h/x', 'g/d/b', 'g/e']:
+            os.makedirs(path)
+        for path in ['g/a/x.js', 'g/a/b/y.js', 'g/a/b/c/z.jsx', 'g/d/b/q.js', 'g/e/.env', 'g/f.txt', 'top.txt']:
+            open(path, 'w').close()
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        shutil.rmtree(self._root)
+
+    def assert_covers_glob(self, path_glob):
+        expected = {path.rstrip(os.sep) for path in glob.iglob(path_glob, recursive=True)}
+        roots = set(iter_roots(path_glob))
+
+        # Every root is something glob yields, and everything glob yields is, or is under, a root.
+        self.assertLessEqual(roots, expected, path_glob)
+        for path in expected:
+            self.assertTrue(any(path == root or path.startswith(root + os.sep) for root in roots),
+                            f"{path_glob}: {path} not covered by {sorted(roots)}")
+
+    def test_no_magic(self):
+        self.assertEqual(list(iter_roots('g/a')), ['g/a'])
+        self.assertEqual(list(iter_roots('nope')), [])
+
+    def test_wildcards(self):
+        for path_glob in ['g/*', 'g/*/', 'g/[ad]', 'g/?/b', '*/a', 'nope/*', 'g/e/*']:
+            self.assert_covers_glob(path_glob)
+
+    def test_hidden(self):
+        self.assertEqual(list(iter_roots('g/e/.*')), ['g/e/.env'])
+        self.assert_covers_glob('g/e/.*')
+
+    def test_recursive(self):
+        for path_glob in ['g/**', 'g/**/', 'g/**/*.js', 'g/**/b', '**/c', '*/**/b/*.js']:
+            self.assert_covers_glob(path_glob)
+
+    def test_trailing_recursive_is_not_expanded(self):
+        self.assertEqual(list(iter_roots('g/**')), ['g'])
+        self.assertEqual(sorted(iter_roots('g/?/**')), ['g/a', 'g/d', 'g/e'])
+
+    def test_bare_recursive_keeps_relative_spelling(self):
+        self.assertEqual(sorted(iter_roots('**')), ['g', 'top.txt'])
+        self.assertEqual(sorted(iter_roots('**/')), ['g'])
+        self.assert_covers_glob('**')
+
+    def test_absolute(self):
+        for path_glob in [os.path.join(self._root, 'g', '*'), os.path.join(self._root, '**', 'c')]:
+            self.assert_covers_glob(path_glob)
+
+
+if __name__ == '__main__':
+    unittest.main()